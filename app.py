@@ -2,20 +2,30 @@ import streamlit as st
 import google.generativeai as genai
 from netmiko import ConnectHandler, NetmikoTimeoutException, NetmikoAuthenticationException
 import re
-import time
+import regex
 import os
+import time
+import atexit
+import shutil
+import functools
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
 
 # ==========================================
 # 1. Configuration & Constants
 # ==========================================
 
 # NOTE: 本番環境では st.secrets を使用して管理することを推奨します
-# ローカル実行用に、ここに直接キーを記述するか、st.secrets["GOOGLE_API_KEY"] を使用してください
-if "GOOGLE_API_KEY" in st.secrets:
-    GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"]
-else:
-    # ここにあなたのAPIキーを貼り付けてください
-    GOOGLE_API_KEY = "YOUR_GEMINI_API_KEY_HERE" 
+# ローカル実行用に、st.secrets["GOOGLE_API_KEY"] または環境変数 GOOGLE_API_KEY を設定してください
+@functools.cache
+def _api_key() -> str:
+    """GeminiのAPIキーを初回利用時に取得します（import時のsecrets読み込みを回避）"""
+    try:
+        return st.secrets.get("GOOGLE_API_KEY", os.environ.get("GOOGLE_API_KEY", ""))
+    except FileNotFoundError:
+        # secrets.toml が存在しない環境では環境変数のみを使用
+        return os.environ.get("GOOGLE_API_KEY", "")
 
 # Cisco DevNet Always-On Sandbox Connection Details
 # 検証結果に基づき、混雑の少ないNX-OS(Nexus 9000)を採用
@@ -31,80 +41,238 @@ SANDBOX_DEVICE = {
     'conn_timeout': 30,             
 }
 
+# 生ログ一時ファイルの保持期間（秒）
+# cached_fetch のTTL(60秒)より長くし、キャッシュ済み結果の参照先が先に消えないようにする
+_RAW_LOG_RETENTION = 600
+
+# 一括送信したコマンド出力の終端を確認するためのコマンド（出力は破棄）
+_BATCH_SENTINEL_CMD = "show clock"
+
 # AI Model Configuration
 # 最新の高速モデルを指定
 MODEL_NAME = 'gemini-2.0-flash'
 
+# 固定の指示文はシステム指示としてモデルに設定し、リクエストごとにはログのみを送信する
+SYSTEM_PROMPT = """
+    あなたはデータセンターネットワークのスペシャリストAIです。
+    送信されるログはCisco Nexus (NX-OS) スイッチから取得・サニタイズされたステータスログです。
+    これを分析し、以下のフォーマットでレポートを作成してください。
+
+    ### 🛡️ Nexus 自動診断レポート
+    **判定**: [ 正常 / 注意 / 異常 ] から選択
+    
+    **1. デバイス概要**
+    *   NX-OSバージョン、稼働時間(Uptime)、プラットフォーム(Chassis)を簡潔に。
+    
+    **2. インターフェース状態**
+    *   接続されている主要なインターフェース(Eth1/1など)のステータス(up/down)を確認。
+    *   VLANや管理ポート(mgmt0)の状態について言及。
+    
+    **3. ルーティング状況**
+    *   認識されているルート数や、デフォルトゲートウェイの有無。
+    
+    **4. 考察と推奨アクション**
+    *   ログから読み取れるネットワークの健全性と、もしあれば追加確認すべきコマンド。
+    """
+
+# Sanitize Rules (import時に一度だけコンパイル)
+# 1. Passwords / Secrets / Community Strings
+# 固定キーワードで始まるため、キーワードを含む行だけをトークン単位で走査する
+_CREDENTIAL_KEYWORDS = ('password', 'secret', 'community')
+# 値トークンのうちマスク対象とする先頭の非空白部分
+_VALUE_RE = re.compile(r'\S+')
+
+# 残りの正規表現ルールは1つの選択パターンに統合し、1回の走査で処理する
+# マッチした名前付きグループで置換内容を切り替える（_mask_match）
+# IP/MACはASCIIのCLI出力が対象のため ASCII フラグを指定
+# 否定先読みを含むため、バックトラックに強い regex モジュールでコンパイル
+_SENSITIVE_RE = regex.compile(
+    # username ... secret ... は複数トークンの文脈が必要なため正規表現で処理
+    # 設定行は必ず(インデント付きの)行頭から始まるため ^ で固定し、行頭以外での照合を省く
+    # （sanitize_output は1行ずつ適用するため MULTILINE は不要）
+    r'(?P<user>^(?P<user_prefix>\s*username \S+ privilege \d+ secret \d+) \S+)'
+    # 2. Public IP Masking
+    # 10.x, 172.16-31.x, 192.168.x (プライベートIP) 以外をマスク対象とする
+    r'|(?P<ip>\b(?!(?:10|172\.(?:1[6-9]|2\d|3[01])|192\.168)\.)\d{1,3}\.(?:\d{1,3}\.){2}\d{1,3}\b)'
+    # 3. MAC Address
+    r'|(?P<mac>(?:[0-9A-Fa-f]{4}\.){2}[0-9A-Fa-f]{4})',
+    regex.ASCII,
+)
+_SENSITIVE_MASKS = {
+    'ip': '<MASKED_PUBLIC_IP>',
+    'mac': '<MASKED_MAC>',
+}
+
 # ==========================================
 # 2. Functional Logic (Backend)
 # ==========================================
 
-def configure_genai():
-    """Gemini APIの初期設定"""
-    try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        return True
-    except Exception as e:
-        return str(e)
+@dataclass(slots=True)
+class DiagResult:
+    """セッションに保持する診断結果（生ログは一時ファイルに退避し、パスのみ保持）"""
+    sanitized: str
+    raw_ref: str  # 生ログを書き出した一時ファイルのパス
+
+@st.cache_resource
+def get_model():
+    """Gemini APIの初期設定を行い、モデルを生成します（再実行間で共有）"""
+    genai.configure(api_key=_api_key())
+    return genai.GenerativeModel(MODEL_NAME, system_instruction=SYSTEM_PROMPT)
+
+def _mask_value(token: str, mask: str):
+    """
+    値トークン先頭の非空白部分（正規表現の \\S+ 相当）だけを mask に置き換えます。
+    タブ等で続く後続テキストは残し、値が空白で始まる場合は None を返します。
+    """
+    value = _VALUE_RE.match(token)
+    return mask + token[value.end():] if value else None
+
+def _mask_credential_tokens(line: str) -> str:
+    """
+    1行分のパスワード/シークレット/コミュニティ文字列をトークン単位でマスクします。
+    """
+    tokens = line.split(' ')
+
+    # (password|secret) <type> <value> -> (password|secret) <HIDDEN_PASSWORD>
+    i = 0
+    while i < len(tokens) - 2:
+        if tokens[i].endswith(('password', 'secret')) and tokens[i + 1].isdecimal():
+            masked = _mask_value(tokens[i + 2], '<HIDDEN_PASSWORD>')
+            if masked is not None:
+                tokens[i + 1:i + 3] = [masked]
+        i += 1
+
+    # encrypted password <value> / snmp-server community <value>
+    for keyword, prefix, mask in (('password', 'encrypted', '<HIDDEN_PASSWORD>'),
+                                  ('community', 'snmp-server', '<HIDDEN_COMMUNITY>')):
+        for i in range(1, len(tokens) - 1):
+            if tokens[i] == keyword and tokens[i - 1].endswith(prefix):
+                masked = _mask_value(tokens[i + 1], mask)
+                if masked is not None:
+                    tokens[i + 1] = masked
+
+    return ' '.join(tokens)
+
+def _mask_match(m) -> str:
+    """
+    _SENSITIVE_RE のマッチ種別(名前付きグループ)に応じた置換文字列を返します。
+    """
+    if m.lastgroup == 'user':
+        return f"{m.group('user_prefix')} <HIDDEN_SECRET>"
+    return _SENSITIVE_MASKS[m.lastgroup]
 
 def sanitize_output(text: str) -> str:
     """
     機密情報をマスク処理します。
     プライベートIPは残し、グローバルIPのみを隠すロジックを実装しています。
     """
-    rules = [
-        # 1. Passwords / Secrets / Community Strings
-        (r'(password|secret) \d+ \S+', r'\1 <HIDDEN_PASSWORD>'),
-        (r'(encrypted password) \S+', r'\1 <HIDDEN_PASSWORD>'),
-        (r'(snmp-server community) \S+', r'\1 <HIDDEN_COMMUNITY>'),
-        (r'(username \S+ privilege \d+ secret \d+) \S+', r'\1 <HIDDEN_SECRET>'),
-        
-        # 2. Public IP Masking
-        # 10.x, 172.16-31.x, 192.168.x (プライベートIP) 以外をマスク対象とする正規表現
-        (r'\b(?!(?:10|172\.(?:1[6-9]|2\d|3[01])|192\.168)\.)\d{1,3}\.(?:\d{1,3}\.){2}\d{1,3}\b', '<MASKED_PUBLIC_IP>'),
-        
-        # 3. MAC Address
-        (r'([0-9A-Fa-f]{4}\.){2}[0-9A-Fa-f]{4}', '<MASKED_MAC>'),
-    ]
-    
-    sanitized_text = text
-    for pattern, replacement in rules:
-        sanitized_text = re.sub(pattern, replacement, sanitized_text)
-        
-    return sanitized_text
+    # テキスト全体に手掛かり（キーワード / '.'）が無いルールは行走査ごと省略する
+    needs_credential = any(k in text for k in _CREDENTIAL_KEYWORDS)
+    needs_network = '.' in text
+    if not (needs_credential or needs_network):
+        return text
+
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        # 1. 認証情報: キーワードを含む行だけを処理
+        has_credential = needs_credential and any(k in line for k in _CREDENTIAL_KEYWORDS)
+        if has_credential:
+            line = _mask_credential_tokens(line)
+
+        # 2-3. username/IP/MACは統合パターンで1回だけ走査する
+        # IP(x.x.x.x)もMAC(xxxx.xxxx.xxxx)も '.' を2つ以上含むため、それ未満の行はスキップ
+        if has_credential or (needs_network and line.count('.') >= 2):
+            line = _SENSITIVE_RE.sub(_mask_match, line)
+
+        lines[i] = line
+
+    return '\n'.join(lines)
+
+@st.cache_resource
+def _raw_log_dir() -> Path:
+    """
+    生ログ用のプロセス専用一時ディレクトリを返します（プロセス終了時に削除）。
+    """
+    path = Path(tempfile.mkdtemp(prefix="ai-netops-raw-"))
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+def _prune_raw_logs(directory: Path) -> None:
+    """
+    保持期間(_RAW_LOG_RETENTION)を過ぎた生ログの一時ファイルを削除します。
+    """
+    cutoff = time.time() - _RAW_LOG_RETENTION
+    for path in directory.glob("*.log"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass  # 他のセッションが同時に削除済み
+
+def _split_batch_output(buffer: str, prompt: str, commands: list) -> dict:
+    """
+    一括送信したコマンド群の出力を、各コマンドのエコー行（プロンプト + コマンド）で分割します。
+    終端マーカー(_BATCH_SENTINEL_CMD)のエコーが見つからない場合は出力欠落とみなします。
+    """
+    # 先頭コマンドのエコーはプロンプトを伴わないため、残っていれば除去する
+    first_echo = re.match(rf'\s*{re.escape(commands[0])}[ \t]*\n', buffer)
+    rest = buffer[first_echo.end():] if first_echo else buffer
+
+    outputs = {}
+    for cmd, next_cmd in zip(commands, commands[1:] + [_BATCH_SENTINEL_CMD]):
+        echo = re.search(rf'^{re.escape(prompt)}\s*{re.escape(next_cmd)}[ \t]*$', rest, re.MULTILINE)
+        if echo is None:
+            raise ValueError(f"Incomplete batch output: echo of '{next_cmd}' not found")
+        outputs[cmd] = rest[:echo.start()].strip('\n')
+        rest = rest[echo.end():]
+
+    return outputs
 
 def connect_and_fetch() -> dict:
     """
     実機(NX-OS)にSSH接続し、コマンドを実行して結果を返します。
     """
     # NX-OS用にコマンドを調整
+    # ページネーションはNetmikoのセッション準備で無効化されるため terminal length 0 は不要
     commands = [
-        "terminal length 0",            # ページネーション無効化
         "show version",                 # システム情報
         "show interface brief",         # インターフェース状態一覧
         "show ip route",                # ルーティング情報
     ]
     
-    raw_output = ""
-    
     try:
         with ConnectHandler(**SANDBOX_DEVICE) as ssh:
             # プロンプト取得
             prompt = ssh.find_prompt()
-            raw_output += f"Connected to: {prompt}\n"
+            parts = [f"Connected to: {prompt}\n"]
+
+            # 全コマンドを1回の送信にまとめ、コマンドごとのプロンプト待ちを省略する
+            # 無通信時間ではなく、終端マーカー実行後のプロンプトが現れるまで読み込む
+            script = "\n".join(commands + [_BATCH_SENTINEL_CMD])
+            ssh.write_channel(ssh.normalize_cmd(script))
+            buffer = ssh.read_until_pattern(
+                pattern=rf"{re.escape(prompt)}[ \t]*{re.escape(_BATCH_SENTINEL_CMD)}[ \t]*\n.*?\n{re.escape(prompt)}",
+                re_flags=re.DOTALL,
+                read_timeout=60,
+            )
 
-            for cmd in commands:
-                # コマンド送信
-                output = ssh.send_command(cmd)
-                raw_output += f"\n{'='*30}\n[Command] {cmd}\n{output}\n"
-                # 連続実行エラー防止のため少し待機
-                time.sleep(0.5)
+        results = _split_batch_output(buffer, prompt, commands)
+        for cmd in commands:
+            parts.append(f"\n{'='*30}\n[Command] {cmd}\n{results[cmd]}\n")
+        raw_output = "".join(parts)
 
         # 成功時: サニタイズ処理を実行
         sanitized = sanitize_output(raw_output)
+
+        # 生ログはメモリに保持せず一時ファイルへ退避（デバッグ表示時のみ読み込む）
+        # 古いファイルはここで削除し、生ログがディスクに残り続けないようにする
+        log_dir = _raw_log_dir()
+        _prune_raw_logs(log_dir)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".log", dir=log_dir, delete=False) as f:
+            f.write(raw_output)
         return {
             "success": True, 
-            "raw": raw_output, 
+            "raw_ref": f.name, 
             "sanitized": sanitized
         }
             
@@ -113,44 +281,59 @@ def connect_and_fetch() -> dict:
     except Exception as e:
         return {"success": False, "error": f"System Error: {str(e)}"}
 
-def ask_gemini_agent(sanitized_log: str) -> str:
+def _compact_log(text: str) -> str:
+    """
+    プロンプト送信用にログを圧縮します。
+    空行と区切り線(=====)を除去し、トークン数を削減します。
+    """
+    return '\n'.join(
+        line for line in text.splitlines()
+        if line.strip() and not line.startswith('===')
+    )
+
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_fetch(host: str) -> dict:
+    """
+    connect_and_fetch() の結果を接続先ホストごとに60秒間キャッシュします。
+    """
+    return connect_and_fetch()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_ai(prompt: str) -> str:
+    """
+    Geminiの応答をストリーミングで受信し、受信した分から逐次描画して全文を返します。
+    同一プロンプトは5分間キャッシュされ、再実行時は描画結果ごと再生されます。
+    （例外はキャッシュされないため、失敗時は次回に再試行されます）
+    """
+    # キャッシュ再生のため、描画先はこの関数内で生成する
+    placeholder = st.empty()
+    response = get_model().generate_content(prompt, stream=True)
+    buf = ""
+    for chunk in response:
+        buf += chunk.text
+        placeholder.markdown(buf)
+    return buf
+
+def ask_gemini_agent(sanitized_log: str, placeholder) -> str:
     """
     サニタイズされたログをGeminiに送信し、解析結果を取得します。
+    応答はストリーミングで受信し、受信した分から placeholder に逐次描画します。
     """
     # APIキー未設定チェック
-    if "YOUR_GEMINI_API_KEY" in GOOGLE_API_KEY:
-        return "⚠️ エラー: ソースコード内の `GOOGLE_API_KEY` に正しいAPIキーを設定してください。"
+    if not _api_key():
+        # 未設定の結果はキャッシュに残さず、キー設定後の再実行で読み直す
+        _api_key.cache_clear()
+        return "⚠️ エラー: st.secrets または環境変数の `GOOGLE_API_KEY` に正しいAPIキーを設定してください。"
 
     prompt = f"""
-    あなたはデータセンターネットワークのスペシャリストAIです。
-    以下はCisco Nexus (NX-OS) スイッチから取得・サニタイズされたステータスログです。
-    これを分析し、以下のフォーマットでレポートを作成してください。
-
-    ### 🛡️ Nexus 自動診断レポート
-    **判定**: [ 正常 / 注意 / 異常 ] から選択
-    
-    **1. デバイス概要**
-    *   NX-OSバージョン、稼働時間(Uptime)、プラットフォーム(Chassis)を簡潔に。
-    
-    **2. インターフェース状態**
-    *   接続されている主要なインターフェース(Eth1/1など)のステータス(up/down)を確認。
-    *   VLANや管理ポート(mgmt0)の状態について言及。
-    
-    **3. ルーティング状況**
-    *   認識されているルート数や、デフォルトゲートウェイの有無。
-    
-    **4. 考察と推奨アクション**
-    *   ログから読み取れるネットワークの健全性と、もしあれば追加確認すべきコマンド。
-
     --- Log Data Start ---
-    {sanitized_log}
+    {_compact_log(sanitized_log)}
     --- Log Data End ---
     """
     
     try:
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(prompt)
-        return response.text
+        with placeholder.container():
+            return cached_ai(prompt)
     except Exception as e:
         return f"🤖 AI Agent Error: {str(e)}"
 
@@ -168,11 +351,6 @@ def main():
     Nexus 9000 Sandbox (Data Center) に自律接続し、Gemini 2.0 Flash が診断を行います。
     """)
     
-    # API設定チェック
-    api_check = configure_genai()
-    if api_check is not True:
-        st.error(f"Gemini API Config Error: {api_check}")
-
     # Sidebar
     with st.sidebar:
         st.header("Agent Status")
@@ -183,6 +361,11 @@ def main():
 
     # Main Layout
     col1, col2 = st.columns([1, 1])
+    report_tabs = ["🤖 AI Analysis", "🔒 Sanitized Log", "🔍 Raw Log (Debug)"]
+
+    with col2:
+        # レポート表示領域（AI応答のストリーミング中も同じ場所に描画する）
+        report_area = st.empty()
 
     with col1:
         st.subheader("📡 Operation Console")
@@ -196,9 +379,11 @@ def main():
                 
                 # Step 1: Network Connection
                 st.write("🔌 Establishing SSH Connection to Nexus Sandbox...")
-                result = connect_and_fetch()
+                result = cached_fetch(SANDBOX_DEVICE['host'])
                 
                 if not result["success"]:
+                    # 失敗結果はキャッシュに残さず、次回は再接続する
+                    cached_fetch.clear()
                     status.update(label="Connection Failed", state="error")
                     st.error(result['error'])
                     # エラー詳細の表示（トラブルシュート用）
@@ -210,12 +395,18 @@ def main():
                 
                 # Step 2: AI Analysis
                 st.write(f"🧠 Requesting AI Analysis ({MODEL_NAME})...")
-                ai_response = ask_gemini_agent(result["sanitized"])
+                with report_area.container():
+                    st.subheader("📋 Agent Report")
+                    tab1, _, _ = st.tabs(report_tabs)
+                    ai_placeholder = tab1.empty()
+                ai_response = ask_gemini_agent(result["sanitized"], ai_placeholder)
                 
                 status.update(label="All Tasks Completed!", state="complete", expanded=False)
                 
                 # 結果をセッションステートに保存（再描画対策）
-                st.session_state['diag_result'] = result
+                st.session_state['diag_result'] = DiagResult(
+                    sanitized=result["sanitized"], raw_ref=result["raw_ref"]
+                )
                 st.session_state['ai_response'] = ai_response
 
     # 結果表示エリア（セッションステートがあれば表示）
@@ -223,23 +414,28 @@ def main():
         result = st.session_state['diag_result']
         ai_response = st.session_state['ai_response']
         
-        with col2:
+        # ストリーミング表示を完成版のレポートで置き換える
+        with report_area.container():
             st.subheader("📋 Agent Report")
             
             # タブで表示切り替え
-            tab1, tab2, tab3 = st.tabs(["🤖 AI Analysis", "🔒 Sanitized Log", "🔍 Raw Log (Debug)"])
+            tab1, tab2, tab3 = st.tabs(report_tabs)
             
             with tab1:
                 st.markdown(ai_response)
                 
             with tab2:
-                st.caption("AIに送信されたデータ（機密情報マスク済み）")
-                st.code(result["sanitized"], language="text")
+                st.caption("機密情報マスク済みのログ（AIには空行と区切り線を除いて送信）")
+                st.code(result.sanitized, language="text")
                 
             with tab3:
                 st.warning("注意: ここには生データが表示されます（管理者用）")
-                with st.expander("生ログを表示"):
-                    st.code(result["raw"], language="text")
+                # 表示を選んだときだけ一時ファイルから生ログを読み込む
+                if st.toggle("生ログを表示"):
+                    try:
+                        st.code(Path(result.raw_ref).read_text(encoding="utf-8"), language="text")
+                    except FileNotFoundError:
+                        st.info("生ログの保持期間が過ぎたため削除されました。再度診断を実行してください。")
 
 if __name__ == "__main__":
     main()